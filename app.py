@@ -1,11 +1,15 @@
 import os
+from datetime import datetime
 
 from flask import Flask, render_template, request, flash, redirect, session, g, url_for
+from flask_caching import Cache
 from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import func, literal, select
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Follows, Likes
+from models import db, connect_db, User, Message, Follows, Likes, FeedItem
 
 CURR_USER_KEY = "curr_user"
 
@@ -20,9 +24,51 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
+
+# Connection-pool tuning:
+#   - pre_ping: cheap SELECT 1 on checkout, so a stale/killed connection
+#     is replaced instead of failing mid-query after a DB restart
+#   - recycle: retire idle connections before provider/pgbouncer
+#     idle-timeouts kill them out from under us
+#   - size/overflow: enough headroom for the WSGI worker threads without
+#     paying a reconnect per request
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    # SQLite (used by the fast test mode) has no server-side pool to
+    # tune; a StaticPool keeps the single in-memory database alive
+    # across connections instead
+    from sqlalchemy.pool import StaticPool
+
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'poolclass': StaticPool,
+        'connect_args': {'check_same_thread': False},
+    }
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 20,
+        'max_overflow': 10,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+    }
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+
+# Bcrypt work factor, tunable per deployment: each +1 doubles hashing
+# time, so pick the highest value the hardware tolerates (~250ms)
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+
+# Cache backend for per-session data (use Redis in production by setting
+# CACHE_TYPE=redis and CACHE_REDIS_URL; defaults to an in-process cache
+# so local dev and tests don't need a Redis server running)
+app.config['CACHE_TYPE'] = os.environ.get('CACHE_TYPE', 'simple')
+app.config['CACHE_REDIS_URL'] = os.environ.get(
+    'CACHE_REDIS_URL', 'redis://localhost:6379/0')
+
+# Only mount the debug toolbar when actually debugging - its
+# per-request hooks otherwise run in production for nothing
+if app.debug:
+    toolbar = DebugToolbarExtension(app)
+
+cache = Cache(app)
 
 connect_db(app)
 
@@ -31,12 +77,34 @@ connect_db(app)
 # User signup/login/logout
 
 
+@cache.memoize(timeout=60)
+def _load_user(user_id):
+    """Fetch a user by id, memoized in the cache for a short TTL.
+
+    Saves a database round-trip on every request for what is effectively
+    static per-session data; falls back to SQL on a cache miss.
+    """
+
+    return User.query.get(user_id)
+
+
 @app.before_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
+    # Static assets never render user state; skip the session check
+    # and cache/DB lookup entirely
+    if request.endpoint == 'static':
+        g.user = None
+        return
+
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        user = _load_user(session[CURR_USER_KEY])
+
+        # The cached instance is detached from the current request's
+        # session; merge it back in (load=False skips the SELECT) so
+        # relationship access keeps working as before.
+        g.user = db.session.merge(user, load=False) if user else None
 
     else:
         g.user = None
@@ -133,12 +201,23 @@ def list_users():
 
     search = request.args.get('q')
 
+    # Bound both listings - an unbounded .all() on a growing users
+    # table is a latent DoS
     if not search:
-        users = User.query.all()
+        users = User.query.limit(50).all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        # Case-insensitive match, written as lower() LIKE lower() so
+        # the expression trigram index on lower(username) serves it
+        users = (User.query
+                 .filter(func.lower(User.username)
+                         .like(f"%{search.lower()}%"))
+                 .limit(50)
+                 .all())
 
-    return render_template('users/index.html', users=users)
+    following = _following_ids(g.user.id) if g.user else set()
+
+    return render_template('users/index.html', users=users,
+                           following=following)
 
 # On a profile page, it should show how many warblers that user has 
 # liked, and this should link to a page showing their liked warbles.
@@ -150,15 +229,68 @@ def users_show(user_id):
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
+    query = (Message
+             .query
+             .options(selectinload(Message.user))
+             .filter(Message.user_id == user_id))
+
+    before = _before_cursor()
+    if before:
+        query = query.filter(Message.timestamp < before)
+
+    messages = (query
                 .order_by(Message.timestamp.desc())
                 .limit(100)
                 .all())
     return render_template('users/show.html', user=user, messages=messages)
 
 
+def _before_cursor():
+    """Parse the optional `?before=<iso timestamp>` keyset cursor.
+
+    Keyset ("WHERE timestamp < cursor") pagination keeps every page as
+    cheap as the first one - OFFSET would re-scan and discard all the
+    rows already shown. Returns None for a missing or malformed cursor.
+    """
+
+    before = request.args.get('before')
+
+    if not before:
+        return None
+
+    try:
+        return datetime.fromisoformat(before)
+    except ValueError:
+        return None
+
+
+def _liked_message_ids(user_id):
+    """Set of message ids this user has liked.
+
+    Selects just the integer ids from `likes` instead of traversing
+    `g.user.likes`, which would hydrate a full Message object per row
+    only to throw everything but the id away. A set keeps the
+    `msg.id in likes` checks in the templates O(1).
+    """
+
+    return {m_id for (m_id,) in
+            db.session.query(Likes.message_id).filter(Likes.user_id == user_id)}
+
+
+def _following_ids(user_id):
+    """Set of user ids this user follows.
+
+    The user-list templates used to call `g.user.is_following(...)`
+    per card, which issues one SELECT per rendered user. One query
+    over `follows` up front and an O(1) set check in the template
+    replaces that N+1 - same shape as `_liked_message_ids`.
+    """
+
+    return {u_id for (u_id,) in
+            db.session.query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id)}
+
+
 @app.route('/users/<int:user_id>/likes')
 def users_likes(user_id):
 
@@ -166,15 +298,22 @@ def users_likes(user_id):
 
     if g.user:
 
-        messages = (Message
-                    .query
-                    .join(Likes, Message.id == Likes.message_id)
-                    .filter(Likes.user_id == g.user.id)
+        query = (Message
+                 .query
+                 .options(selectinload(Message.user))
+                 .join(Likes, Message.id == Likes.message_id)
+                 .filter(Likes.user_id == g.user.id))
+
+        before = _before_cursor()
+        if before:
+            query = query.filter(Message.timestamp < before)
+
+        messages = (query
                     .order_by(Message.timestamp.desc())
                     .limit(100)
                     .all())
 
-        likes = [msg.id for msg in g.user.likes]
+        likes = _liked_message_ids(g.user.id)
 
         return render_template('users/likes.html', user=user, messages=messages, likes=likes)
 
@@ -188,7 +327,9 @@ def show_following(user_id):
         return redirect(url_for('homepage'))
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    following = _following_ids(g.user.id)
+    return render_template('users/following.html', user=user,
+                           following=following)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -200,7 +341,9 @@ def users_followers(user_id):
         return redirect(url_for('homepage'))
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    following = _following_ids(g.user.id)
+    return render_template('users/followers.html', user=user,
+                           following=following)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -211,10 +354,34 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect(url_for('homepage'))
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    # Following yourself would double up your own messages in the feed
+    # fan-out (the author row is already written at post time)
+    if follow_id == g.user.id:
+        flash("You cannot follow yourself.", "danger")
+        return redirect(url_for('homepage'))
+
+    # Insert the follow row directly instead of g.user.following.append,
+    # which would load the whole following collection first
+    User.query.get_or_404(follow_id)
+    db.session.add(Follows(
+        user_being_followed_id=follow_id, user_following_id=g.user.id))
+
+    # Backfill the new followee's messages into this user's feed so
+    # they show up without waiting for the followee's next post
+    db.session.execute(
+        FeedItem.__table__.insert().from_select(
+            ['user_id', 'message_id', 'timestamp'],
+            select([literal(g.user.id), Message.id, Message.timestamp])
+            .where(Message.user_id == follow_id),
+        )
+    )
+
     db.session.commit()
 
+    # Drop the cached user and feed so stale follow state isn't served
+    cache.delete_memoized(_load_user, g.user.id)
+    cache.delete_memoized(_feed_ids, g.user.id)
+
     return redirect(f"/users/{g.user.id}/following")
 
 
@@ -226,10 +393,27 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect(url_for('homepage'))
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    # Delete the follow row directly instead of g.user.following.remove,
+    # which would load the whole following collection just to drop one row
+    (Follows.query
+     .filter_by(user_following_id=g.user.id,
+                user_being_followed_id=follow_id)
+     .delete(synchronize_session=False))
+
+    # Drop the ex-followee's messages from this user's feed
+    (FeedItem.query
+     .filter(FeedItem.user_id == g.user.id,
+             FeedItem.message_id.in_(
+                 db.session.query(Message.id)
+                 .filter(Message.user_id == follow_id)))
+     .delete(synchronize_session=False))
+
     db.session.commit()
 
+    # Drop the cached user and feed so stale follow state isn't served
+    cache.delete_memoized(_load_user, g.user.id)
+    cache.delete_memoized(_feed_ids, g.user.id)
+
     return redirect(f"/users/{g.user.id}/following")
 
 
@@ -261,6 +445,8 @@ def profile():
             g.user.bio = form.bio.data
             # commit the changes to the databse
             db.session.commit()
+            # Drop the cached user so the updated profile is served
+            cache.delete_memoized(_load_user, g.user.id)
             flash("Profile updated successfully!", "success")
             return redirect(url_for('users_show', user_id=g.user.id))
         else:
@@ -280,6 +466,9 @@ def delete_user():
 
     do_logout()
 
+    # Drop the cached user so the deleted account can't be served
+    cache.delete_memoized(_load_user, g.user.id)
+
     db.session.delete(g.user)
     db.session.commit()
 
@@ -305,8 +494,34 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+
+        # Flush so the message gets its id/timestamp, then fan it out:
+        # one feed row for the author plus one per follower, written at
+        # post time so the homepage never has to join follows
+        db.session.flush()
+
+        db.session.add(FeedItem(
+            user_id=g.user.id, message_id=msg.id, timestamp=msg.timestamp))
+        db.session.execute(
+            FeedItem.__table__.insert().from_select(
+                ['user_id', 'message_id', 'timestamp'],
+                select([Follows.user_following_id,
+                        literal(msg.id),
+                        literal(msg.timestamp)])
+                .where(Follows.user_being_followed_id == g.user.id)
+                # A self-follow row (e.g. one predating the guard in
+                # add_follow) must not collide with the author row
+                # inserted above
+                .where(Follows.user_following_id != g.user.id),
+            )
+        )
+
         db.session.commit()
 
+        # The new message changes the author's feed and every
+        # follower's feed; drop their memoized id lists
+        _invalidate_feeds(g.user.id)
+
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
@@ -316,7 +531,9 @@ def messages_add():
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    # Join in the author so rendering the template doesn't fire a
+    # second lazy SELECT for msg.user
+    msg = Message.query.options(joinedload(Message.user)).get(message_id)
     return render_template('messages/show.html', message=msg)
 
 
@@ -329,9 +546,14 @@ def messages_destroy(message_id):
         return redirect(url_for('homepage'))
 
     msg = Message.query.get(message_id)
+    author_id = msg.user_id
     db.session.delete(msg)
     db.session.commit()
 
+    # The deleted message drops out of the author's feed and every
+    # follower's feed; drop their memoized id lists
+    _invalidate_feeds(author_id)
+
     return redirect(f"/users/{g.user.id}")
 
 
@@ -339,6 +561,32 @@ def messages_destroy(message_id):
 # Homepage and error pages
 
 
+@cache.memoize(timeout=30)
+def _feed_ids(user_id):
+    """Last 100 message ids in a user's feed, newest first.
+
+    Memoized for a short TTL: the feed only changes when someone in the
+    follow set posts, so repeat homepage views within the window skip
+    the database entirely.
+    """
+
+    return [m_id for (m_id,) in
+            db.session.query(FeedItem.message_id)
+            .filter(FeedItem.user_id == user_id)
+            .order_by(FeedItem.timestamp.desc())
+            .limit(100)]
+
+
+def _invalidate_feeds(author_id):
+    """Drop memoized feeds for an author and all of their followers."""
+
+    cache.delete_memoized(_feed_ids, author_id)
+    followers = (db.session.query(Follows.user_following_id)
+                 .filter(Follows.user_being_followed_id == author_id))
+    for (follower_id,) in followers:
+        cache.delete_memoized(_feed_ids, follower_id)
+
+
 @app.route('/')
 def homepage():
     """Show homepage:
@@ -348,21 +596,36 @@ def homepage():
     """
 
     if g.user:
-        # Using conditional inner join
-        # Show the last 100 messages only from:
-        #   1. the users that the logged-in user is following
-        #   2. and the logged-in user
-        # `follows` and `messages` tables have no relationship set up
+        # Show the last 100 messages from the precomputed feed:
+        # the fan-out rows written in `messages_add` cover the
+        # logged-in user's own messages and everyone they follow.
+        # The id list comes from the short-TTL cache; only the
+        # message rows themselves are fetched here.
+
+        before = _before_cursor()
+        if before:
+            # Deeper pages are hit far less often than the first one,
+            # so skip the cache and keyset straight off the feed index
+            feed_ids = [m_id for (m_id,) in
+                        db.session.query(FeedItem.message_id)
+                        .filter(FeedItem.user_id == g.user.id,
+                                FeedItem.timestamp < before)
+                        .order_by(FeedItem.timestamp.desc())
+                        .limit(100)]
+        else:
+            feed_ids = _feed_ids(g.user.id)
 
         messages = (Message
                     .query
-                    .join(Follows, Message.user_id == Follows.user_being_followed_id)
-                    .filter((Message.user_id==g.user.id) | (Follows.user_following_id==g.user.id))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
+                    .options(selectinload(Message.user))
+                    .filter(Message.id.in_(feed_ids))
                     .all())
 
-        likes = [msg.id for msg in g.user.likes]
+        # IN (...) gives no ordering guarantee; restore feed order
+        by_id = {msg.id: msg for msg in messages}
+        messages = [by_id[m_id] for m_id in feed_ids if m_id in by_id]
+
+        likes = _liked_message_ids(g.user.id)
 
         return render_template('home.html', messages=messages, likes=likes)
 
@@ -383,20 +646,22 @@ def page_not_found(e):
     return render_template('404.html', error=e), 404
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Cache-Control headers
+#   (static assets are immutable and safe to cache long-term; HTML is
+#   per-user, so the browser must revalidate it on every view)
 
 @app.after_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Set coherent caching headers on every response."""
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
+    if request.path.startswith('/static/'):
+        # Long-lived browser/CDN caching for assets; bump the filename
+        # (or add a version query string) when an asset changes
+        req.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        # Private per-user pages: cacheable by the browser only, and
+        # revalidated before reuse
+        req.headers['Cache-Control'] = 'private, no-cache'
     return req
 
 
@@ -419,15 +684,24 @@ def toggle_like(msg_id):
         flash("You cannot like your own warble.", "danger")
         return redirect(url_for('homepage'))
     
-    # Update liked messsage 
-    if message in g.user.likes:
-        g.user.likes.remove(message)
-    else: 
-        g.user.likes.append(message)
+    # Update liked messsage
+    # Look up the single Likes row directly instead of `message in
+    # g.user.likes`, which would load the user's entire likes
+    # collection just to check membership of one message
+    existing_like = Likes.query.filter_by(
+        user_id=g.user.id, message_id=msg_id).first()
+
+    if existing_like:
+        db.session.delete(existing_like)
+    else:
+        db.session.add(Likes(user_id=g.user.id, message_id=msg_id))
 
     # Update database
     db.session.commit()
 
+    # Drop the cached user so stale like state isn't served
+    cache.delete_memoized(_load_user, g.user.id)
+
     return redirect(url_for('homepage'))
 
     # NOT ABLE TO TOGGLE A LIKED MESSAGE
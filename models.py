@@ -6,12 +6,37 @@ from datetime import datetime
 from flask_bcrypt import Bcrypt
 # SQLAlchemy for ORM (Object Relational Mapping) with Flask
 from flask_sqlalchemy import SQLAlchemy
+# DDL/event for Postgres-only schema extras (pg_trgm extension)
+from sqlalchemy import DDL, event
 
 # Create an instance of Bcrypt for pw hashing
 bcrypt = Bcrypt()
 # Create an instance of SQLAlchemy to interact with the database
 db = SQLAlchemy()
 
+# Hash compared against when a username doesn't exist, so `authenticate`
+# costs the same whether or not the account is real (see below). Built
+# lazily rather than at import, which would run before init_app and
+# bake in the default cost of 12 - on an app tuned via
+# BCRYPT_LOG_ROUNDS, that would make unknown-username checks take a
+# different time than real ones, the very leak the dummy hash closes.
+_DUMMY_HASH = None
+_DUMMY_HASH_ROUNDS = None
+
+
+def _dummy_password_hash():
+    """The dummy hash at the currently configured work factor."""
+
+    global _DUMMY_HASH, _DUMMY_HASH_ROUNDS
+
+    rounds = getattr(bcrypt, '_log_rounds', 12)
+
+    if _DUMMY_HASH is None or _DUMMY_HASH_ROUNDS != rounds:
+        _DUMMY_HASH = bcrypt.generate_password_hash("<dummy>").decode('UTF-8')
+        _DUMMY_HASH_ROUNDS = rounds
+
+    return _DUMMY_HASH
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -44,7 +69,13 @@ class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     # Specifies database table name
-    __tablename__ = 'likes' 
+    __tablename__ = 'likes'
+
+    # A user can like a given message only once, but different users
+    # can each like the same message
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id'),
+    )
 
     # Define a primary key column
     id = db.Column(
@@ -61,12 +92,9 @@ class Likes(db.Model):
 
     # Define a foreign key column in `messages` table
     # deletes cascade if a message is deleted
-    ######
-    # Ensure that each message can only be liked once ######
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
     )
 
 
@@ -134,7 +162,9 @@ class User(db.Model):
     # Can get list of messages objects from user with `.messages`
     # `users` is the referenced table
     # `messages` is the referencing table
-    messages = db.relationship('Message')
+    # Ordered by id so the collection comes back in insertion order
+    # regardless of which index the planner picks
+    messages = db.relationship('Message', order_by='Message.id')
 
     ### SELF-REFERENTIAL MANY-TO-MANY RELATIONSHIPS ###
 
@@ -180,18 +210,22 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        # List comprehension to find followers
-        found_user_list = [user for user in self.followers if user == other_user]
-        # Returns True if other_user is found, else Flase
-        return len(found_user_list) == 1
+        # Targeted LIMIT-1 lookup on the follows primary key instead of
+        # loading the entire followers collection just to check one row
+        return Follows.query.filter_by(
+            user_being_followed_id=self.id,
+            user_following_id=other_user.id,
+        ).first() is not None
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        # List comprehension to find followed users
-        found_user_list = [user for user in self.following if user == other_user]
-        # Returns True if other_user is found, else Flase
-        return len(found_user_list) == 1
+        # Targeted LIMIT-1 lookup on the follows primary key instead of
+        # loading the entire following collection just to check one row
+        return Follows.query.filter_by(
+            user_following_id=self.id,
+            user_being_followed_id=other_user.id,
+        ).first() is not None
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -230,19 +264,47 @@ class User(db.Model):
         # Queries the database for the first user with the given username
         user = cls.query.filter_by(username=username).first()
 
-        # Check if the user was found
-        if user:
-            # Checkes if the provided password matches the stored hash
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            # If authentication is successful
-            if is_auth:
-                # Returns the user instance
-                return user
+        # Always run the bcrypt check - against a dummy hash when the
+        # username doesn't exist - so the response time doesn't leak
+        # which usernames are real (skipping bcrypt on a miss makes
+        # unknown usernames measurably faster)
+        hashed = user.password if user else _dummy_password_hash()
+        is_auth = bcrypt.check_password_hash(hashed, password)
+
+        # If authentication is successful
+        if user and is_auth:
+            # Returns the user instance
+            return user
 
         # Retruns False if user is not found or password is incorrect
         return False
 
 
+def _pg_trgm_available(ddl, target, connection, **kw):
+    """Can this Postgres server load the pg_trgm extension?"""
+
+    return connection.dialect.name == 'postgresql' and connection.scalar(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    ) is not None
+
+
+# Trigram GIN index on lower(username) so the unanchored
+# `lower(username) LIKE '%...%'` search in `/users` is answered by the
+# index instead of a sequential scan (a B-tree only helps anchored
+# patterns). Created after the table DDL, and only where the pg_trgm
+# extension is actually available, so `db.create_all()` still works
+# elsewhere.
+event.listen(
+    User.__table__,
+    'after_create',
+    DDL(
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm; '
+        'CREATE INDEX IF NOT EXISTS idx_users_username_lower_trgm '
+        'ON users USING gin (lower(username) gin_trgm_ops)'
+    ).execute_if(callable_=_pg_trgm_available),
+)
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
@@ -268,8 +330,11 @@ class Message(db.Model):
         db.DateTime,
         # Timestamp cannot be bull
         nullable=False,
-        # Sets the default to the current UTC time
-        default=datetime.utcnow(),
+        # Sets the default to the current UTC time.
+        # Pass the callable itself (no parens!) so it's evaluated per
+        # row at INSERT time - calling it here would stamp every new
+        # message with the server's boot time
+        default=datetime.utcnow,
     )
 
     # Define a user id foreignkey
@@ -287,6 +352,53 @@ class Message(db.Model):
     user = db.relationship('User')
 
 
+class FeedItem(db.Model):
+    """Denormalized fan-out of a message into each reader's home feed.
+
+    One row per (reader, message), written when the message is posted,
+    so the homepage is a plain index scan on the reader's id instead of
+    a messages-to-follows join sorted on every pageview.
+    """
+
+    # Specifies table name
+    __tablename__ = 'feed_items'
+
+    # The reader whose feed this row belongs to
+    # deletes cascade if the user is deleted
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # The message shown in that feed
+    # deletes cascade if the message is deleted
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # Copy of the message timestamp so the feed can be sorted
+    # without joining back to messages
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+# Serves the homepage query: filter on user_id, newest first, LIMIT 100
+db.Index('idx_feed_items_user_ts', FeedItem.user_id, FeedItem.timestamp.desc())
+
+
+# Composite index for the feed queries: homepage and the profile page
+# both filter on user_id and ORDER BY timestamp DESC LIMIT 100, so this
+# turns a sequential scan + sort into an index range scan + limit.
+# (The follows join is already covered by that table's composite
+# primary key on (user_being_followed_id, user_following_id).)
+db.Index('idx_messages_user_ts', Message.user_id, Message.timestamp.desc())
+
+
 # Establishes a connection between a FLASK APPLICATION and a SQLAlchemy DATABASE
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -298,6 +410,11 @@ def connect_db(app):
     # Tell SQLAlchemy which Flask app it should work with
     db.app = app
 
+    # Pick up the app's bcrypt settings (BCRYPT_LOG_ROUNDS) so the
+    # hashing work factor is tunable per deployment instead of always
+    # using the library default
+    bcrypt.init_app(app)
+
     # A helper method that initializes the Flask app with SQLAlchemy
     # It configures the app so that the database can be accessed within the app'scontext
     # This ensures that the Flask app is fully integrated with SQLAlchemy and is ready to handle database queries or operations
@@ -1,8 +1,9 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
+from sqlalchemy import select
 from app import db
-from models import User, Message, Follows
+from models import User, Message, Follows, FeedItem
 
 
 db.drop_all()
@@ -17,4 +18,20 @@ with open('generator/messages.csv') as messages:
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
+# Backfill the precomputed feed: every author sees their own messages,
+# and every follower sees the messages of the users they follow
+db.session.execute(
+    FeedItem.__table__.insert().from_select(
+        ['user_id', 'message_id', 'timestamp'],
+        select([Message.user_id, Message.id, Message.timestamp]),
+    )
+)
+db.session.execute(
+    FeedItem.__table__.insert().from_select(
+        ['user_id', 'message_id', 'timestamp'],
+        select([Follows.user_following_id, Message.id, Message.timestamp])
+        .where(Follows.user_being_followed_id == Message.user_id),
+    )
+)
+
 db.session.commit()